@@ -85,6 +85,25 @@ scheduler.add_job(
     replace_existing=True
 )
 
+# Task: Tính lại dung lượng storage mỗi giờ
+# (file chat và ảnh paste được ghi trực tiếp vào uploads, không qua bộ đếm của file_storage)
+def recompute_storage_size():
+    """Đồng bộ lại bộ đếm dung lượng storage với dữ liệu thực tế"""
+    try:
+        file_storage.recompute_storage_size()
+    except Exception as e:
+        print(f"✗ Storage recompute error: {e}")
+        app.logger.error(f"Storage recompute error: {e}")
+
+scheduler.add_job(
+    func=recompute_storage_size,
+    trigger='interval',
+    hours=1,
+    id='recompute_storage_size',
+    name='Recompute storage size',
+    replace_existing=True
+)
+
 # Start scheduler
 scheduler.start()
 print("✓ Scheduler started: Auto cleanup old messages every 6 hours")
@@ -359,31 +378,34 @@ def process_pasted_images_in_content(note_id, content):
             shutil.copy2(temp_path, attachment_path)
             
             # Thêm vào metadata của note
-            metadata = file_storage._load_metadata()
-            for note_meta in metadata.get('notes', []):
-                if note_meta['id'] == int(note_id):
-                    if 'attachments' not in note_meta:
-                        note_meta['attachments'] = []
-                    
-                    note_meta['attachments'].append({
-                        'filename': unique_filename,
-                        'original_filename': secure_filename(original_name),
-                        'uploaded_at': datetime.utcnow().isoformat()
-                    })
-                    note_meta['updated_at'] = datetime.utcnow().isoformat()
-                    file_storage._save_metadata(metadata)
-                    
-                    # Tạo URL mới cho attachment
-                    new_url = url_for('download_attachment', note_id=note_id, filename=unique_filename)
-                    # Thay thế URL cũ bằng URL mới trong content
-                    updated_content = updated_content.replace(full_url, new_url)
-                    
-                    # Xóa file tạm sau khi đã chuyển thành attachment
-                    try:
-                        os.remove(temp_path)
-                    except:
-                        pass
-                    break
+            # Giữ lock của file_storage khi sửa metadata dùng chung
+            with file_storage._lock:
+                metadata = file_storage._load_metadata()
+                for note_meta in metadata.get('notes', []):
+                    if note_meta['id'] == int(note_id):
+                        if 'attachments' not in note_meta:
+                            note_meta['attachments'] = []
+                        
+                        note_meta['attachments'].append({
+                            'filename': unique_filename,
+                            'original_filename': secure_filename(original_name),
+                            'uploaded_at': datetime.utcnow().isoformat()
+                        })
+                        note_meta['updated_at'] = datetime.utcnow().isoformat()
+                        file_storage._add_storage_bytes(metadata, os.path.getsize(attachment_path))
+                        file_storage._save_metadata(metadata)
+                        
+                        # Tạo URL mới cho attachment
+                        new_url = url_for('download_attachment', note_id=note_id, filename=unique_filename)
+                        # Thay thế URL cũ bằng URL mới trong content
+                        updated_content = updated_content.replace(full_url, new_url)
+                        
+                        # Xóa file tạm sau khi đã chuyển thành attachment
+                        try:
+                            os.remove(temp_path)
+                        except:
+                            pass
+                        break
                     
         except Exception as e:
             print(f"Lỗi khi xử lý pasted image {temp_filename}: {str(e)}")
@@ -718,7 +740,7 @@ def notes():
     category = request.args.get('category', 'all')
     search_query = request.args.get('search', '')
     
-    notes_list = file_storage.get_all_notes(category=category, search_query=search_query)
+    notes_list = file_storage.get_all_notes(category=category, search_query=search_query, include_content=True)
     categories = file_storage.get_note_categories()
     categories_dict = load_categories()
     
@@ -1018,7 +1040,7 @@ def docs():
     category = request.args.get('category', 'all')
     search_query = request.args.get('search', '')
     
-    docs_list = file_storage.get_all_docs(category=category, search_query=search_query)
+    docs_list = file_storage.get_all_docs(category=category, search_query=search_query, include_content=True)
     categories = file_storage.get_doc_categories()
     categories_dict = load_categories()
     
@@ -1291,8 +1313,8 @@ def api_search():
     results = {'notes': [], 'docs': []}
     
     if query:
-        notes = file_storage.get_all_notes(search_query=query)[:5]
-        docs = file_storage.get_all_docs(search_query=query)[:5]
+        notes = file_storage.get_all_notes(search_query=query, limit=5)
+        docs = file_storage.get_all_docs(search_query=query, limit=5)
         
         results['notes'] = [{'id': n.id, 'title': n.title, 'type': 'note'} for n in notes]
         results['docs'] = [{'id': d.id, 'title': d.title, 'type': 'doc'} for d in docs]
@@ -1742,6 +1764,9 @@ def export_data():
         temp_dir = tempfile.mkdtemp()
         zip_path = os.path.join(temp_dir, zip_filename)
         
+        # Đảm bảo metadata đang chờ đã được ghi xuống file trước khi đóng gói
+        file_storage.flush()
+        
         with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             # 1. Export users.csv
             if os.path.exists(user_storage.csv_file):
@@ -1888,6 +1913,8 @@ def import_data():
         # 2. Import metadata.json
         metadata_file = os.path.join(extract_dir, 'metadata.json')
         if os.path.exists(metadata_file):
+            # Ghi hết metadata đang chờ để thread nền không ghi đè lên file được import
+            file_storage.flush()
             if import_mode == 'replace':
                 # Backup file cũ
                 if os.path.exists(file_storage.metadata_file):
@@ -1900,33 +1927,35 @@ def import_data():
                 # Merge mode: đọc cả hai và merge
                 with open(metadata_file, 'r', encoding='utf-8') as f:
                     imported_metadata = json.load(f)
-                current_metadata = file_storage._load_metadata()
-                
-                # Đảm bảo current_metadata có cấu trúc đúng
-                if 'notes' not in current_metadata or not isinstance(current_metadata['notes'], list):
-                    current_metadata['notes'] = []
-                if 'docs' not in current_metadata or not isinstance(current_metadata['docs'], list):
-                    current_metadata['docs'] = []
-                
-                # Merge notes
-                imported_notes = imported_metadata.get('notes', [])
-                if isinstance(imported_notes, list):
-                    imported_note_ids = {n['id'] for n in imported_notes if isinstance(n, dict) and 'id' in n}
-                    current_metadata['notes'] = [n for n in current_metadata['notes'] 
-                                               if n.get('id') not in imported_note_ids]
-                    current_metadata['notes'].extend(imported_notes)
-                    import_count['notes'] = len(imported_notes)
-                
-                # Merge docs
-                imported_docs = imported_metadata.get('docs', [])
-                if isinstance(imported_docs, list):
-                    imported_doc_ids = {d['id'] for d in imported_docs if isinstance(d, dict) and 'id' in d}
-                    current_metadata['docs'] = [d for d in current_metadata['docs'] 
-                                              if d.get('id') not in imported_doc_ids]
-                    current_metadata['docs'].extend(imported_docs)
-                    import_count['docs'] = len(imported_docs)
-                
-                file_storage._save_metadata(current_metadata)
+                # Giữ lock của file_storage khi sửa metadata dùng chung
+                with file_storage._lock:
+                    current_metadata = file_storage._load_metadata()
+                    
+                    # Đảm bảo current_metadata có cấu trúc đúng
+                    if 'notes' not in current_metadata or not isinstance(current_metadata['notes'], list):
+                        current_metadata['notes'] = []
+                    if 'docs' not in current_metadata or not isinstance(current_metadata['docs'], list):
+                        current_metadata['docs'] = []
+                    
+                    # Merge notes
+                    imported_notes = imported_metadata.get('notes', [])
+                    if isinstance(imported_notes, list):
+                        imported_note_ids = {n['id'] for n in imported_notes if isinstance(n, dict) and 'id' in n}
+                        current_metadata['notes'] = [n for n in current_metadata['notes'] 
+                                                   if n.get('id') not in imported_note_ids]
+                        current_metadata['notes'].extend(imported_notes)
+                        import_count['notes'] = len(imported_notes)
+                    
+                    # Merge docs
+                    imported_docs = imported_metadata.get('docs', [])
+                    if isinstance(imported_docs, list):
+                        imported_doc_ids = {d['id'] for d in imported_docs if isinstance(d, dict) and 'id' in d}
+                        current_metadata['docs'] = [d for d in current_metadata['docs'] 
+                                                  if d.get('id') not in imported_doc_ids]
+                        current_metadata['docs'].extend(imported_docs)
+                        import_count['docs'] = len(imported_docs)
+                    
+                    file_storage._save_metadata(current_metadata)
         
         # 3. Import categories.json
         categories_file_import = os.path.join(extract_dir, 'categories.json')
@@ -2052,6 +2081,10 @@ def import_data():
                     shutil.copy2(src, dst)
                     import_count['attachments'] += 1
         
+        # Dữ liệu đã được ghi trực tiếp vào thư mục - bỏ cache của file_storage
+        file_storage.invalidate_cache()
+        file_storage.recompute_storage_size()
+        
         # Dọn dẹp file tạm
         shutil.rmtree(temp_dir)
         
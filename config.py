@@ -4,6 +4,7 @@ Tách riêng cấu hình để dễ quản lý giữa development và production
 """
 import os
 from datetime import timedelta
+from functools import cached_property, lru_cache
 
 class Config:
     """Base configuration"""
@@ -72,8 +73,8 @@ class ProductionConfig(Config):
     # Tăng thời gian session trong production
     PERMANENT_SESSION_LIFETIME = timedelta(hours=8)
     
-    # Bắt buộc phải có SECRET_KEY từ environment
-    @property
+    # Bắt buộc phải có SECRET_KEY từ environment (đọc một lần khi from_object đọc config, cache lại trên instance)
+    @cached_property
     def SECRET_KEY(self):
         secret_key = os.environ.get('SECRET_KEY')
         if not secret_key:
@@ -99,8 +100,9 @@ config = {
 }
 
 
+@lru_cache(maxsize=None)
 def get_config(env=None):
-    """Get configuration based on environment"""
+    """Get configuration based on environment (trả về instance để property SECRET_KEY được tính, cache theo env)"""
     if env is None:
         env = os.environ.get('FLASK_ENV', 'development')
-    return config.get(env, config['default'])
+    return config.get(env, config['default'])()
@@ -3,9 +3,34 @@ Module quản lý Notes và Documents bằng file text
 """
 import os
 import json
+import queue
+import atexit
+import secrets
+import shutil
+import threading
 from datetime import datetime
+from werkzeug.utils import secure_filename
+
+# O_NOATIME chỉ có trên Linux: đọc file không ghi lại thời gian truy cập (atime)
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
+
+
+def _noatime_opener(path, flags):
+    """Opener cho open(): thêm O_NOATIME nếu có, mở bình thường nếu không phải owner của file"""
+    if _O_NOATIME:
+        try:
+            return os.open(path, flags | _O_NOATIME)
+        except PermissionError:
+            pass
+    return os.open(path, flags)
+
 
 class FileStorage:
+    # Lượt xem được gom trong bộ nhớ, ghi metadata theo chu kỳ thay vì mỗi request
+    VIEW_COUNT_FLUSH_INTERVAL = 30  # Giây
+    VIEW_COUNT_FLUSH_THRESHOLD = 100  # Ghi ngay khi đủ số lượt xem chưa lưu
+    UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024  # 1MB mỗi lần copy khi lưu file upload
+    
     def __init__(self, notes_dir='data/notes', docs_dir='data/docs', metadata_file='data/metadata.json', uploads_dir='uploads'):
         # Chuẩn hóa tất cả đường dẫn thành absolute path để đảm bảo lưu đúng vị trí
         self.notes_dir = os.path.abspath(os.path.normpath(notes_dir))
@@ -24,169 +49,408 @@ class FileStorage:
         if metadata_dir:
             os.makedirs(metadata_dir, exist_ok=True)
         
+        # Cache metadata trong bộ nhớ, làm mới khi mtime của file thay đổi
+        self._meta_cache = None
+        self._meta_mtime = 0
+        # Index id -> metadata để tra cứu O(1), build lại mỗi khi cache được làm mới
+        self._notes_by_id = {}
+        self._docs_by_id = {}
+        self._note_titles_lower = {}
+        self._doc_titles_lower = {}
+        # Cache nội dung (lowercase) id -> content cho tìm kiếm, nạp dần khi cần
+        self._note_content_cache = {}
+        self._doc_content_cache = {}
+        
+        # Lock bảo vệ cache metadata dùng chung giữa các thread: mọi thao tác load-sửa-lưu phải giữ lock
+        self._lock = threading.RLock()
+        # Lượt xem chưa ghi xuống file (note_id -> số lượt), bảo vệ bởi self._lock
+        self._pending_view_increments = {}
+        self._pending_view_total = 0
+        self._flush_timer = None
+        
+        # Metadata được ghi xuống file bởi một thread nền duy nhất, request không phải chờ ghi file
+        self._save_queue = queue.Queue()
+        # Số thứ tự snapshot: _save_seq tăng mỗi lần lưu, _loaded_seq là _save_seq tại lần cache được load lại từ file
+        self._save_seq = 0
+        self._loaded_seq = 0
+        # Snapshot (seq, data) mới nhất bị ghi lỗi, được ghi lại ở lần flush tiếp theo
+        self._unsaved = None
+        self._save_thread = threading.Thread(target=self._save_worker, daemon=True)
+        self._save_thread.start()
+        atexit.register(self.flush)
+        
         # Khởi tạo metadata file nếu chưa tồn tại
         if not os.path.exists(self.metadata_file):
             self._save_metadata({'notes': [], 'docs': []})
+            self._save_queue.join()
     
     def _load_metadata(self):
-        """Load metadata từ file JSON"""
-        try:
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {'notes': [], 'docs': []}
+        """Load metadata từ file JSON (dùng cache nếu file chưa thay đổi)"""
+        with self._lock:
+            try:
+                st = os.stat(self.metadata_file)
+                if self._meta_cache is not None and st.st_mtime_ns == self._meta_mtime:
+                    return self._meta_cache
+                
+                with open(self.metadata_file, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+                # Chỉ giữ cache khi build index thành công (lỗi thì lần sau load lại từ file)
+                self._index_metadata(metadata)
+                self._meta_cache = metadata
+                self._meta_mtime = st.st_mtime_ns
+                self._loaded_seq = self._save_seq
+                self._unsaved = None
+                # Áp lại các lượt xem chưa được ghi vào metadata vừa load
+                for note_id, count in self._pending_view_increments.items():
+                    note_meta = self._notes_by_id.get(note_id)
+                    if note_meta:
+                        note_meta['view_count'] = note_meta.get('view_count', 0) + count
+                # File bị thay đổi từ bên ngoài (process khác, import) - nội dung cache có thể đã cũ
+                self._note_content_cache.clear()
+                self._doc_content_cache.clear()
+                return metadata
+            except (OSError, ValueError):
+                metadata = {'notes': [], 'docs': []}
+                self._index_metadata(metadata)
+                return metadata
+    
+    def invalidate_cache(self):
+        """Bỏ toàn bộ cache, dùng khi dữ liệu bị ghi trực tiếp vào thư mục (vd: import)"""
+        self.flush()
+        with self._lock:
+            self._meta_cache = None
+            self._meta_mtime = 0
+            self._loaded_seq = self._save_seq
+            self._unsaved = None
+            self._note_content_cache.clear()
+            self._doc_content_cache.clear()
+    
+    def flush(self):
+        """Ghi các lượt xem đang chờ (và snapshot bị ghi lỗi trước đó), đợi thread nền ghi xong metadata xuống file"""
+        self._flush_view_counts()
+        with self._lock:
+            if self._unsaved is not None:
+                self._save_queue.put(self._unsaved)
+                self._unsaved = None
+        self._save_queue.join()
+    
+    def _index_metadata(self, metadata):
+        """Build lại index id -> metadata (và tiêu đề lowercase cho tìm kiếm) cho notes và docs"""
+        self._notes_by_id = {m['id']: m for m in metadata.get('notes', [])}
+        self._docs_by_id = {m['id']: m for m in metadata.get('docs', [])}
+        self._note_titles_lower = {m['id']: (m.get('title') or '').lower() for m in metadata.get('notes', [])}
+        self._doc_titles_lower = {m['id']: (m.get('title') or '').lower() for m in metadata.get('docs', [])}
     
     def _save_metadata(self, metadata):
-        """Lưu metadata vào file JSON"""
-        try:
-            # Đảm bảo thư mục tồn tại
-            metadata_dir = os.path.dirname(self.metadata_file)
-            if metadata_dir:
-                os.makedirs(metadata_dir, exist_ok=True)
+        """Cập nhật cache và đưa metadata vào hàng đợi để thread nền ghi xuống file JSON"""
+        with self._lock:
+            try:
+                # Serialize ngay (dạng gọn, không indent) để có snapshot cố định cho thread nền
+                data = json.dumps(metadata, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            except Exception as e:
+                raise Exception(f"Không thể lưu metadata: {str(e)}")
             
+            # Lượt xem đang chờ đã nằm trong snapshot này
+            self._pending_view_increments.clear()
+            self._pending_view_total = 0
+            
+            # Cập nhật cache bằng chính dict vừa lưu, không cần parse lại
+            self._meta_cache = metadata
+            self._index_metadata(metadata)
+            self._save_seq += 1
+            # Snapshot mới đã bao gồm thay đổi của snapshot bị ghi lỗi (nếu có)
+            self._unsaved = None
+            self._save_queue.put((self._save_seq, data))
+    
+    def _save_worker(self):
+        """Thread nền: gộp các snapshot đang chờ trong hàng đợi, chỉ ghi bản mới nhất"""
+        while True:
+            seq, data = self._save_queue.get()
+            count = 1
+            while True:
+                try:
+                    seq, data = self._save_queue.get_nowait()
+                    count += 1
+                except queue.Empty:
+                    break
+            
+            try:
+                self._write_metadata(seq, data)
+            except Exception as e:
+                with self._lock:
+                    # Cache vẫn là snapshot này -> giữ lại để ghi lại, không để thay đổi chỉ còn trong bộ nhớ
+                    if seq == self._save_seq and seq > self._loaded_seq:
+                        self._unsaved = (seq, data)
+                print(f"✗ {e} (sẽ ghi lại ở lần lưu hoặc flush tiếp theo)")
+            finally:
+                for _ in range(count):
+                    self._save_queue.task_done()
+    
+    def _write_metadata(self, seq, data):
+        """Ghi snapshot metadata số seq (bytes) xuống file (atomic)"""
+        temp_file = self.metadata_file + '.tmp'
+        try:
             # Ghi file với atomic write (ghi vào file tạm trước)
-            temp_file = self.metadata_file + '.tmp'
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            # File có buffer: write/close ghi đủ toàn bộ dữ liệu hoặc báo lỗi (không bị ghi thiếu âm thầm)
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
             
             # Thay thế file cũ bằng file mới (os.replace hoạt động trên cả Windows và Linux từ Python 3.3+)
             # os.replace() là atomic và tương thích đa nền tảng
-            os.replace(temp_file, self.metadata_file)
+            # Giữ lock để _load_metadata không coi file mình vừa ghi là bị thay đổi từ bên ngoài
+            with self._lock:
+                os.replace(temp_file, self.metadata_file)
+                # Chỉ cập nhật mtime khi cache vẫn dựng trên snapshot này (không bị load lại từ file
+                # của process khác sau khi snapshot được đưa vào hàng đợi); nếu không, lần load sau đọc lại file
+                if seq > self._loaded_seq:
+                    self._meta_mtime = os.stat(self.metadata_file).st_mtime_ns
         except Exception as e:
             # Nếu có lỗi, xóa file tạm nếu tồn tại
-            temp_file = self.metadata_file + '.tmp'
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
             raise Exception(f"Không thể lưu metadata: {str(e)}")
     
+    def _read_text(self, filepath):
+        """Đọc file text bằng một lần read (binary + decode), không cập nhật atime nếu hệ điều hành hỗ trợ"""
+        with open(filepath, 'rb', opener=_noatime_opener) as f:
+            content = f.read().decode('utf-8')
+        # Giữ nguyên kết quả như đọc ở text mode (universal newlines)
+        if '\r' in content:
+            content = content.replace('\r\n', '\n').replace('\r', '\n')
+        return content
+    
+    def _get_content_lower(self, cache, directory, item_meta):
+        """Lấy nội dung lowercase từ cache, chỉ đọc file nếu chưa có trong cache"""
+        # Giữ lock khi đọc file và ghi vào cache: update_* ghi nội dung mới vào cache dưới cùng lock,
+        # nên nội dung cũ đọc trước lần update không thể ghi đè lên nội dung mới
+        with self._lock:
+            content_lower = cache.get(item_meta['id'])
+            if content_lower is None:
+                filepath = os.path.join(directory, item_meta['filename'])
+                try:
+                    content_lower = self._read_text(filepath).lower()
+                except FileNotFoundError:
+                    return None
+                cache[item_meta['id']] = content_lower
+            return content_lower
+    
+    def _file_size(self, filepath):
+        """Kích thước file (bytes), 0 nếu file không tồn tại"""
+        try:
+            return os.path.getsize(filepath)
+        except OSError:
+            return 0
+    
+    def _remove_file(self, filepath):
+        """Xóa file, trả về số bytes được giải phóng (0 nếu file không tồn tại)"""
+        try:
+            file_size = os.path.getsize(filepath)
+            os.remove(filepath)
+            return file_size
+        except FileNotFoundError:
+            return 0
+    
+    def _save_upload(self, uploaded_file, filepath):
+        """Lưu file upload với buffer lớn, trả về số bytes đã ghi"""
+        with open(filepath, 'wb') as out:
+            shutil.copyfileobj(uploaded_file.stream, out, self.UPLOAD_COPY_BUFFER_SIZE)
+            return out.tell()
+    
+    def _add_storage_bytes(self, metadata, delta):
+        """Cập nhật bộ đếm dung lượng trong metadata (nếu chưa có thì để get_total_storage_size tính lại)"""
+        if '_storage_bytes' in metadata:
+            metadata['_storage_bytes'] = max(0, metadata['_storage_bytes'] + delta)
+    
     def get_next_id(self, item_type='note'):
-        """Lấy ID tiếp theo"""
-        metadata = self._load_metadata()
-        items = metadata.get(item_type + 's', [])
-        if not items:
-            return 1
-        return max(int(item['id']) for item in items) + 1
+        """Lấy ID tiếp theo từ bộ đếm lưu trong metadata (được ghi cùng lần lưu của item mới)"""
+        with self._lock:
+            metadata = self._load_metadata()
+            key = f'_next_{item_type}_id'
+            if key not in metadata:
+                # Metadata cũ chưa có bộ đếm -> khởi tạo từ ID lớn nhất hiện có
+                items = metadata.get(item_type + 's', [])
+                metadata[key] = max((int(item['id']) for item in items), default=0) + 1
+            
+            # Bỏ qua ID đã tồn tại (vd: sau khi import merge)
+            index = self._notes_by_id if item_type == 'note' else self._docs_by_id
+            next_id = metadata[key]
+            while next_id in index:
+                next_id += 1
+            metadata[key] = next_id + 1
+            return next_id
     
     # === NOTES METHODS ===
     def create_note(self, title, content, category='general', user_id=None):
         """Tạo note mới"""
-        note_id = self.get_next_id('note')
-        
-        # Đảm bảo thư mục tồn tại
-        os.makedirs(self.notes_dir, exist_ok=True)
-        
-        # Lưu nội dung vào file text
-        filename = f"{note_id}.txt"
-        filepath = os.path.join(self.notes_dir, filename)
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
-        except Exception as e:
-            raise Exception(f"Không thể tạo file ghi chú: {str(e)}")
-        
-        # Thêm metadata
-        metadata = self._load_metadata()
-        note_meta = {
-            'id': note_id,
-            'title': title,
-            'filename': filename,
-            'category': category,
-            'user_id': user_id,
-            'attachments': [],  # Danh sách file đính kèm
-            'view_count': 0,  # Số lần xem (để sắp xếp theo độ phổ biến)
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        metadata['notes'].append(note_meta)
-        self._save_metadata(metadata)
-        
-        return self.get_note(note_id)
+        with self._lock:
+            note_id = self.get_next_id('note')
+            
+            # Lưu nội dung vào file text
+            filename = f"{note_id}.txt"
+            filepath = os.path.join(self.notes_dir, filename)
+            try:
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    f.write(content)
+            except Exception as e:
+                raise Exception(f"Không thể tạo file ghi chú: {str(e)}")
+            self._note_content_cache[note_id] = content.lower()
+            
+            # Thêm metadata
+            metadata = self._load_metadata()
+            self._add_storage_bytes(metadata, self._file_size(filepath))
+            note_meta = {
+                'id': note_id,
+                'title': title,
+                'filename': filename,
+                'category': category,
+                'user_id': user_id,
+                'attachments': [],  # Danh sách file đính kèm
+                'view_count': 0,  # Số lần xem (để sắp xếp theo độ phổ biến)
+                'created_at': datetime.utcnow().isoformat(),
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            metadata['notes'].append(note_meta)
+            self._save_metadata(metadata)
+            
+            return self.get_note(note_id)
     
     def get_note(self, note_id):
         """Lấy note theo ID"""
-        metadata = self._load_metadata()
-        for note_meta in metadata.get('notes', []):
-            if note_meta['id'] == int(note_id):
-                # Đọc nội dung từ file
-                filepath = os.path.join(self.notes_dir, note_meta['filename'])
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    return Note(
-                        id=note_meta['id'],
-                        title=note_meta['title'],
-                        content=content,
-                        category=note_meta.get('category', 'general'),
-                        user_id=note_meta.get('user_id'),
-                        attachments=note_meta.get('attachments', []),
-                        view_count=note_meta.get('view_count', 0),
-                        created_at=datetime.fromisoformat(note_meta['created_at']),
-                        updated_at=datetime.fromisoformat(note_meta.get('updated_at', note_meta['created_at'])),
-                        updated_by=note_meta.get('updated_by')
-                    )
+        self._load_metadata()
+        note_meta = self._notes_by_id.get(int(note_id))
+        if note_meta:
+            # Đọc nội dung từ file
+            filepath = os.path.join(self.notes_dir, note_meta['filename'])
+            try:
+                content = self._read_text(filepath)
+            except FileNotFoundError:
+                return None
+            
+            return Note(
+                id=note_meta['id'],
+                title=note_meta['title'],
+                content=content,
+                category=note_meta.get('category', 'general'),
+                user_id=note_meta.get('user_id'),
+                attachments=note_meta.get('attachments', []),
+                view_count=note_meta.get('view_count', 0),
+                created_at=note_meta['created_at'],
+                updated_at=note_meta.get('updated_at', note_meta['created_at']),
+                updated_by=note_meta.get('updated_by')
+            )
         return None
     
-    def get_all_notes(self, category=None, search_query=None):
-        """Lấy tất cả notes (có thể filter)"""
+    def get_all_notes(self, category=None, search_query=None, include_content=False, limit=None, offset=0):
+        """Lấy tất cả notes (có thể filter, phân trang bằng limit/offset). include_content=False: chỉ lấy metadata, không đọc file nội dung"""
         metadata = self._load_metadata()
         notes = []
+        matched = []
+        query = search_query.lower() if search_query else None
         
-        for note_meta in metadata.get('notes', []):
+        # Duyệt trên bản sao danh sách: thread khác có thể thêm/xóa trong lúc đang duyệt
+        for note_meta in list(metadata.get('notes', [])):
             # Filter theo category
             if category and category != 'all' and note_meta.get('category') != category:
                 continue
             
-            # Đọc nội dung
-            filepath = os.path.join(self.notes_dir, note_meta['filename'])
-            if os.path.exists(filepath):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Filter theo search query
-                if search_query:
-                    if search_query.lower() not in note_meta['title'].lower() and \
-                       search_query.lower() not in content.lower():
+            # Filter theo search query (so khớp trên tiêu đề/nội dung lowercase đã cache, không đọc lại file)
+            if query:
+                title_lower = self._note_titles_lower.get(note_meta['id'])
+                if title_lower is None:
+                    # Item vừa được thêm bởi thread khác, index chưa kịp build lại
+                    title_lower = (note_meta.get('title') or '').lower()
+                if query not in title_lower:
+                    content_lower = self._get_content_lower(self._note_content_cache, self.notes_dir, note_meta)
+                    if content_lower is None or query not in content_lower:
                         continue
-                
-                note = Note(
-                    id=note_meta['id'],
-                    title=note_meta['title'],
-                    content=content,
-                    category=note_meta.get('category', 'general'),
-                    user_id=note_meta.get('user_id'),
-                    attachments=note_meta.get('attachments', []),
-                    view_count=note_meta.get('view_count', 0),
-                    created_at=datetime.fromisoformat(note_meta['created_at']),
-                    updated_at=datetime.fromisoformat(note_meta.get('updated_at', note_meta['created_at'])),
-                    updated_by=note_meta.get('updated_by')
-                )
-                notes.append(note)
+            
+            # Bỏ qua item mất file nội dung ở mọi chế độ, trước khi phân trang để trang không bị thiếu
+            if not os.path.isfile(os.path.join(self.notes_dir, note_meta['filename'])):
+                continue
+            
+            matched.append(note_meta)
+        
+        # Sắp xếp theo updated_at giảm dần trên metadata (chuỗi ISO-8601 so sánh trực tiếp, không cần parse)
+        matched.sort(key=lambda m: m.get('updated_at', m['created_at']), reverse=True)
+        
+        # Phân trang trước khi đọc file/tạo object
+        if limit is not None:
+            matched = matched[offset:offset + limit]
+        elif offset:
+            matched = matched[offset:]
+        
+        for note_meta in matched:
+            # Đọc nội dung (trang chỉ cần danh sách/thống kê thì không đọc file)
+            content = ''
+            if include_content or search_query:
+                filepath = os.path.join(self.notes_dir, note_meta['filename'])
+                try:
+                    content = self._read_text(filepath)
+                except FileNotFoundError:
+                    # File vừa bị xóa sau bước lọc ở trên: giữ item để trang đủ số lượng
+                    pass
+            
+            note = Note(
+                id=note_meta['id'],
+                title=note_meta['title'],
+                content=content,
+                category=note_meta.get('category', 'general'),
+                user_id=note_meta.get('user_id'),
+                attachments=note_meta.get('attachments', []),
+                view_count=note_meta.get('view_count', 0),
+                created_at=note_meta['created_at'],
+                updated_at=note_meta.get('updated_at', note_meta['created_at']),
+                updated_by=note_meta.get('updated_by')
+            )
+            notes.append(note)
         
-        # Sắp xếp theo updated_at giảm dần
-        notes.sort(key=lambda x: x.updated_at, reverse=True)
         return notes
     
     def increment_note_view_count(self, note_id):
-        """Tăng số lần xem của note"""
-        metadata = self._load_metadata()
-        for note_meta in metadata.get('notes', []):
-            if note_meta['id'] == int(note_id):
+        """Tăng số lần xem của note (ghi xuống file theo lô, xem _flush_view_counts)"""
+        with self._lock:
+            self._load_metadata()
+            note_meta = self._notes_by_id.get(int(note_id))
+            if note_meta:
                 note_meta['view_count'] = note_meta.get('view_count', 0) + 1
-                self._save_metadata(metadata)
+                pending = self._pending_view_increments
+                pending[note_meta['id']] = pending.get(note_meta['id'], 0) + 1
+                self._pending_view_total += 1
+                
+                if self._pending_view_total >= self.VIEW_COUNT_FLUSH_THRESHOLD:
+                    self._flush_view_counts()
+                elif self._flush_timer is None:
+                    self._flush_timer = threading.Timer(self.VIEW_COUNT_FLUSH_INTERVAL, self._flush_view_counts)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
                 return True
-        return False
+            return False
+    
+    def _flush_view_counts(self):
+        """Ghi các lượt xem đang chờ vào metadata file"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._pending_view_increments:
+                return
+            try:
+                self._save_metadata(self._load_metadata())
+            except Exception as e:
+                print(f"✗ Không thể lưu lượt xem: {e}")
     
     def update_note(self, note_id, title=None, content=None, category=None, user_id=None):
         """Cập nhật note"""
-        metadata = self._load_metadata()
-        updated = False
-        
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            updated = False
+            
+            note_meta = self._notes_by_id.get(int(note_id))
+            if note_meta:
                 if title is not None:
                     note_meta['title'] = title
                     updated = True
@@ -196,88 +460,100 @@ class FileStorage:
                     updated = True
                 
                 if content is not None:
-                    # Đảm bảo thư mục tồn tại
-                    os.makedirs(self.notes_dir, exist_ok=True)
-                    
                     # Cập nhật file text
                     filepath = os.path.join(self.notes_dir, note_meta['filename'])
+                    old_size = self._file_size(filepath)
                     try:
                         with open(filepath, 'w', encoding='utf-8') as f:
                             f.write(content)
                         updated = True
                     except Exception as e:
                         raise Exception(f"Không thể cập nhật file ghi chú: {str(e)}")
+                    self._add_storage_bytes(metadata, self._file_size(filepath) - old_size)
+                    self._note_content_cache[note_meta['id']] = content.lower()
                 
                 if updated:
                     note_meta['updated_at'] = datetime.utcnow().isoformat()
                     if user_id is not None:
                         note_meta['updated_by'] = user_id
                     self._save_metadata(metadata)
-                break
-        
-        return updated
+            
+            return updated
     
     def delete_note(self, note_id):
         """Xóa note"""
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            note_meta = self._notes_by_id.get(int(note_id))
+            if note_meta:
+                freed = 0
+                
                 # Xóa file text
                 filepath = os.path.join(self.notes_dir, note_meta['filename'])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                freed += self._remove_file(filepath)
                 
                 # Xóa tất cả attachments
                 for attachment in note_meta.get('attachments', []):
                     attach_path = os.path.join(self.notes_uploads_dir, attachment['filename'])
-                    if os.path.exists(attach_path):
-                        os.remove(attach_path)
+                    freed += self._remove_file(attach_path)
                 
                 # Xóa metadata
                 metadata['notes'].remove(note_meta)
+                self._add_storage_bytes(metadata, -freed)
+                self._note_content_cache.pop(note_meta['id'], None)
                 self._save_metadata(metadata)
                 return True
-        return False
+            return False
+    
+    def get_total_storage_size(self, metadata=None):
+        """Tổng dung lượng đã sử dụng (bytes), lấy từ bộ đếm trong metadata"""
+        if metadata is None:
+            metadata = self._load_metadata()
+        if '_storage_bytes' not in metadata:
+            return self.recompute_storage_size()
+        return metadata['_storage_bytes']
     
-    def get_total_storage_size(self):
-        """Tính tổng dung lượng đã sử dụng (bytes)"""
+    def _dir_size(self, directory):
+        """Tổng dung lượng một thư mục (đệ quy), dùng os.scandir để mỗi file chỉ stat một lần"""
         total_size = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        total_size += entry.stat(follow_symlinks=False).st_size
+                    elif entry.is_dir(follow_symlinks=False):
+                        total_size += self._dir_size(entry.path)
+        except FileNotFoundError:
+            pass
+        return total_size
+    
+    def recompute_storage_size(self):
+        """Duyệt lại toàn bộ thư mục để tính dung lượng và ghi đè bộ đếm (sửa sai lệch)"""
+        total_size = (self._dir_size(self.uploads_dir) +
+                      self._dir_size(self.notes_dir) +
+                      self._dir_size(self.docs_dir))
         
-        # Tính dung lượng uploads
-        for root, dirs, files in os.walk(self.uploads_dir):
-            for file in files:
-                filepath = os.path.join(root, file)
-                if os.path.exists(filepath):
-                    total_size += os.path.getsize(filepath)
-        
-        # Tính dung lượng notes
-        for root, dirs, files in os.walk(self.notes_dir):
-            for file in files:
-                filepath = os.path.join(root, file)
-                if os.path.exists(filepath):
-                    total_size += os.path.getsize(filepath)
-        
-        # Tính dung lượng docs
-        for root, dirs, files in os.walk(self.docs_dir):
-            for file in files:
-                filepath = os.path.join(root, file)
-                if os.path.exists(filepath):
-                    total_size += os.path.getsize(filepath)
-        
+        with self._lock:
+            metadata = self._load_metadata()
+            # Bộ đếm đã đúng -> không cần ghi lại metadata
+            if metadata.get('_storage_bytes') != total_size:
+                metadata['_storage_bytes'] = total_size
+                self._save_metadata(metadata)
         return total_size
     
-    def check_storage_available(self, file_size, max_storage=2*1024*1024*1024):
+    def check_storage_available(self, file_size, max_storage=2*1024*1024*1024, metadata=None):
         """
         Kiểm tra xem còn đủ dung lượng để upload file không
         
         Args:
             file_size: Kích thước file muốn upload (bytes)
             max_storage: Giới hạn tổng dung lượng (bytes), mặc định 2GB
+            metadata: Metadata đã load sẵn (tránh load lại), mặc định None
         
         Returns:
             (bool, str): (True/False, message)
         """
-        current_size = self.get_total_storage_size()
+        current_size = self.get_total_storage_size(metadata)
         
         if current_size + file_size > max_storage:
             used_mb = current_size / (1024 * 1024)
@@ -288,184 +564,227 @@ class FileStorage:
     
     def add_note_attachment(self, note_id, uploaded_file):
         """Thêm file đính kèm vào note"""
-        import uuid
-        from werkzeug.utils import secure_filename
+        # Kiểm tra sơ bộ trước khi upload (dùng Content-Length nếu có, không cần seek/tell)
+        # Content-Length do client gửi nên không tin hẳn: kiểm tra lại theo số bytes thực tế sau khi lưu
+        file_size = uploaded_file.content_length
+        if not file_size:
+            uploaded_file.seek(0, 2)  # Seek to end
+            file_size = uploaded_file.tell()
+            uploaded_file.seek(0)  # Reset to beginning
         
-        # Kiểm tra dung lượng trước khi upload
-        uploaded_file.seek(0, 2)  # Seek to end
-        file_size = uploaded_file.tell()
-        uploaded_file.seek(0)  # Reset to beginning
+        with self._lock:
+            metadata = self._load_metadata()
+            can_upload, message = self.check_storage_available(file_size, metadata=metadata)
+            if not can_upload:
+                return False, message
+            if int(note_id) not in self._notes_by_id:
+                return False, "Không tìm thấy ghi chú"
         
-        can_upload, message = self.check_storage_available(file_size)
-        if not can_upload:
-            return False, message
+        # Lấy phần mở rộng file
+        original_filename = secure_filename(uploaded_file.filename)
+        if not original_filename:
+            return False, "Tên file không hợp lệ"
         
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
-                # Lấy phần mở rộng file
-                original_filename = secure_filename(uploaded_file.filename)
-                if not original_filename:
-                    return False, "Tên file không hợp lệ"
-                    
-                file_ext = os.path.splitext(original_filename)[1]
-                
-                # Tạo tên file duy nhất
-                unique_filename = f"{note_id}_{uuid.uuid4().hex[:8]}{file_ext}"
-                filepath = os.path.join(self.notes_uploads_dir, unique_filename)
-                
-                # Lưu file
-                uploaded_file.save(filepath)
-                
-                # Thêm vào metadata
-                if 'attachments' not in note_meta:
-                    note_meta['attachments'] = []
-                
-                note_meta['attachments'].append({
-                    'filename': unique_filename,
-                    'original_filename': original_filename,
-                    'uploaded_at': datetime.utcnow().isoformat()
-                })
-                note_meta['updated_at'] = datetime.utcnow().isoformat()
-                
-                self._save_metadata(metadata)
-                return True, "Upload thành công"
-        return False, "Không tìm thấy ghi chú"
+        file_ext = os.path.splitext(original_filename)[1]
+        
+        # Tạo tên file duy nhất
+        unique_filename = f"{note_id}_{secrets.token_hex(4)}{file_ext}"
+        filepath = os.path.join(self.notes_uploads_dir, unique_filename)
+        
+        # Lưu file (ngoài lock để upload lớn không chặn các request khác)
+        written = self._save_upload(uploaded_file, filepath)
+        
+        with self._lock:
+            metadata = self._load_metadata()
+            note_meta = self._notes_by_id.get(int(note_id))
+            if not note_meta:
+                # Note bị xóa trong lúc đang upload
+                self._remove_file(filepath)
+                return False, "Không tìm thấy ghi chú"
+            
+            can_upload, message = self.check_storage_available(written, metadata=metadata)
+            if not can_upload:
+                self._remove_file(filepath)
+                return False, message
+            
+            self._add_storage_bytes(metadata, written)
+            
+            # Thêm vào metadata
+            if 'attachments' not in note_meta:
+                note_meta['attachments'] = []
+            
+            note_meta['attachments'].append({
+                'filename': unique_filename,
+                'original_filename': original_filename,
+                'uploaded_at': datetime.utcnow().isoformat()
+            })
+            note_meta['updated_at'] = datetime.utcnow().isoformat()
+            
+            self._save_metadata(metadata)
+        return True, "Upload thành công"
     
     def delete_note_attachment(self, note_id, attachment_filename):
         """Xóa file đính kèm từ note - Dù file vật lý còn hay không thì vẫn xóa attachment khỏi metadata"""
-        metadata = self._load_metadata()
-        for note_meta in metadata['notes']:
-            if note_meta['id'] == int(note_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            note_meta = self._notes_by_id.get(int(note_id))
+            if note_meta:
                 attachments = note_meta.get('attachments', [])
                 for attachment in attachments:
                     if attachment['filename'] == attachment_filename:
                         # Xóa file vật lý nếu còn
                         filepath = os.path.join(self.notes_uploads_dir, attachment_filename)
-                        if os.path.exists(filepath):
-                            try:
-                                os.remove(filepath)
-                            except Exception as e:
-                                print(f"[DEBUG] ERROR khi xóa file vật lý: {e}")
+                        try:
+                            self._add_storage_bytes(metadata, -self._remove_file(filepath))
+                        except Exception as e:
+                            print(f"[DEBUG] ERROR khi xóa file vật lý: {e}")
                         # Xóa khỏi metadata (luôn làm)
                         attachments.remove(attachment)
                         note_meta['updated_at'] = datetime.utcnow().isoformat()
                         self._save_metadata(metadata)
                         print(f"[DEBUG] Đã xóa attachment ({attachment_filename}) khỏi metadata note {note_id}")
                         return True
-        print(f"[DEBUG] Không tìm thấy note hoặc attachment: note_id={note_id}, filename={attachment_filename}")
-        return False
+            print(f"[DEBUG] Không tìm thấy note hoặc attachment: note_id={note_id}, filename={attachment_filename}")
+            return False
     
     def get_note_categories(self):
         """Lấy danh sách categories của notes"""
         metadata = self._load_metadata()
         categories = set()
-        for note_meta in metadata.get('notes', []):
+        for note_meta in list(metadata.get('notes', [])):
             categories.add(note_meta.get('category', 'general'))
         return sorted(list(categories))
     
     # === DOCUMENTS METHODS ===
     def create_doc(self, title, content, category='general', user_id=None):
         """Tạo document mới"""
-        doc_id = self.get_next_id('doc')
-        
-        # Đảm bảo thư mục tồn tại
-        os.makedirs(self.docs_dir, exist_ok=True)
-        
-        # Lưu nội dung vào file text
-        filename = f"{doc_id}.txt"
-        filepath = os.path.join(self.docs_dir, filename)
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
-        except Exception as e:
-            raise Exception(f"Không thể tạo file tài liệu: {str(e)}")
-        
-        # Thêm metadata
-        metadata = self._load_metadata()
-        doc_meta = {
-            'id': doc_id,
-            'title': title,
-            'filename': filename,
-            'category': category,
-            'user_id': user_id,
-            'attachments': [],  # Danh sách file đính kèm
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        metadata['docs'].append(doc_meta)
-        self._save_metadata(metadata)
-        
-        return self.get_doc(doc_id)
+        with self._lock:
+            doc_id = self.get_next_id('doc')
+            
+            # Lưu nội dung vào file text
+            filename = f"{doc_id}.txt"
+            filepath = os.path.join(self.docs_dir, filename)
+            try:
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    f.write(content)
+            except Exception as e:
+                raise Exception(f"Không thể tạo file tài liệu: {str(e)}")
+            self._doc_content_cache[doc_id] = content.lower()
+            
+            # Thêm metadata
+            metadata = self._load_metadata()
+            self._add_storage_bytes(metadata, self._file_size(filepath))
+            doc_meta = {
+                'id': doc_id,
+                'title': title,
+                'filename': filename,
+                'category': category,
+                'user_id': user_id,
+                'attachments': [],  # Danh sách file đính kèm
+                'created_at': datetime.utcnow().isoformat(),
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            metadata['docs'].append(doc_meta)
+            self._save_metadata(metadata)
+            
+            return self.get_doc(doc_id)
     
     def get_doc(self, doc_id):
         """Lấy document theo ID"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata.get('docs', []):
-            if doc_meta['id'] == int(doc_id):
-                # Đọc nội dung từ file
-                filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    return Document(
-                        id=doc_meta['id'],
-                        title=doc_meta['title'],
-                        content=content,
-                        category=doc_meta.get('category', 'general'),
-                        user_id=doc_meta.get('user_id'),
-                        attachments=doc_meta.get('attachments', []),
-                        created_at=datetime.fromisoformat(doc_meta['created_at']),
-                        updated_at=datetime.fromisoformat(doc_meta.get('updated_at', doc_meta['created_at']))
-                    )
+        self._load_metadata()
+        doc_meta = self._docs_by_id.get(int(doc_id))
+        if doc_meta:
+            # Đọc nội dung từ file
+            filepath = os.path.join(self.docs_dir, doc_meta['filename'])
+            try:
+                content = self._read_text(filepath)
+            except FileNotFoundError:
+                return None
+            
+            return Document(
+                id=doc_meta['id'],
+                title=doc_meta['title'],
+                content=content,
+                category=doc_meta.get('category', 'general'),
+                user_id=doc_meta.get('user_id'),
+                attachments=doc_meta.get('attachments', []),
+                created_at=doc_meta['created_at'],
+                updated_at=doc_meta.get('updated_at', doc_meta['created_at'])
+            )
         return None
     
-    def get_all_docs(self, category=None, search_query=None):
-        """Lấy tất cả documents (có thể filter)"""
+    def get_all_docs(self, category=None, search_query=None, include_content=False, limit=None, offset=0):
+        """Lấy tất cả documents (có thể filter, phân trang bằng limit/offset). include_content=False: chỉ lấy metadata, không đọc file nội dung"""
         metadata = self._load_metadata()
         docs = []
+        matched = []
+        query = search_query.lower() if search_query else None
         
-        for doc_meta in metadata.get('docs', []):
+        # Duyệt trên bản sao danh sách: thread khác có thể thêm/xóa trong lúc đang duyệt
+        for doc_meta in list(metadata.get('docs', [])):
             # Filter theo category
             if category and category != 'all' and doc_meta.get('category') != category:
                 continue
             
-            # Đọc nội dung
-            filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-            if os.path.exists(filepath):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Filter theo search query
-                if search_query:
-                    if search_query.lower() not in doc_meta['title'].lower() and \
-                       search_query.lower() not in content.lower():
+            # Filter theo search query (so khớp trên tiêu đề/nội dung lowercase đã cache, không đọc lại file)
+            if query:
+                title_lower = self._doc_titles_lower.get(doc_meta['id'])
+                if title_lower is None:
+                    # Item vừa được thêm bởi thread khác, index chưa kịp build lại
+                    title_lower = (doc_meta.get('title') or '').lower()
+                if query not in title_lower:
+                    content_lower = self._get_content_lower(self._doc_content_cache, self.docs_dir, doc_meta)
+                    if content_lower is None or query not in content_lower:
                         continue
-                
-                doc = Document(
-                    id=doc_meta['id'],
-                    title=doc_meta['title'],
-                    content=content,
-                    category=doc_meta.get('category', 'general'),
-                    user_id=doc_meta.get('user_id'),
-                    attachments=doc_meta.get('attachments', []),
-                    created_at=datetime.fromisoformat(doc_meta['created_at']),
-                    updated_at=datetime.fromisoformat(doc_meta.get('updated_at', doc_meta['created_at']))
-                )
-                docs.append(doc)
+            
+            # Bỏ qua item mất file nội dung ở mọi chế độ, trước khi phân trang để trang không bị thiếu
+            if not os.path.isfile(os.path.join(self.docs_dir, doc_meta['filename'])):
+                continue
+            
+            matched.append(doc_meta)
+        
+        # Sắp xếp theo updated_at giảm dần trên metadata (chuỗi ISO-8601 so sánh trực tiếp, không cần parse)
+        matched.sort(key=lambda m: m.get('updated_at', m['created_at']), reverse=True)
+        
+        # Phân trang trước khi đọc file/tạo object
+        if limit is not None:
+            matched = matched[offset:offset + limit]
+        elif offset:
+            matched = matched[offset:]
+        
+        for doc_meta in matched:
+            # Đọc nội dung (trang chỉ cần danh sách/thống kê thì không đọc file)
+            content = ''
+            if include_content or search_query:
+                filepath = os.path.join(self.docs_dir, doc_meta['filename'])
+                try:
+                    content = self._read_text(filepath)
+                except FileNotFoundError:
+                    # File vừa bị xóa sau bước lọc ở trên: giữ item để trang đủ số lượng
+                    pass
+            
+            doc = Document(
+                id=doc_meta['id'],
+                title=doc_meta['title'],
+                content=content,
+                category=doc_meta.get('category', 'general'),
+                user_id=doc_meta.get('user_id'),
+                attachments=doc_meta.get('attachments', []),
+                created_at=doc_meta['created_at'],
+                updated_at=doc_meta.get('updated_at', doc_meta['created_at'])
+            )
+            docs.append(doc)
         
-        # Sắp xếp theo updated_at giảm dần
-        docs.sort(key=lambda x: x.updated_at, reverse=True)
         return docs
     
     def update_doc(self, doc_id, title=None, content=None, category=None):
         """Cập nhật document"""
-        metadata = self._load_metadata()
-        updated = False
-        
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            updated = False
+            
+            doc_meta = self._docs_by_id.get(int(doc_id))
+            if doc_meta:
                 if title is not None:
                     doc_meta['title'] = title
                     updated = True
@@ -475,115 +794,145 @@ class FileStorage:
                     updated = True
                 
                 if content is not None:
-                    # Đảm bảo thư mục tồn tại
-                    os.makedirs(self.docs_dir, exist_ok=True)
-                    
                     # Cập nhật file text
                     filepath = os.path.join(self.docs_dir, doc_meta['filename'])
+                    old_size = self._file_size(filepath)
                     try:
                         with open(filepath, 'w', encoding='utf-8') as f:
                             f.write(content)
                         updated = True
                     except Exception as e:
                         raise Exception(f"Không thể cập nhật file tài liệu: {str(e)}")
+                    self._add_storage_bytes(metadata, self._file_size(filepath) - old_size)
+                    self._doc_content_cache[doc_meta['id']] = content.lower()
                 
                 if updated:
                     doc_meta['updated_at'] = datetime.utcnow().isoformat()
                     self._save_metadata(metadata)
-                break
-        
-        return updated
+            
+            return updated
     
     def delete_doc(self, doc_id):
         """Xóa document"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            doc_meta = self._docs_by_id.get(int(doc_id))
+            if doc_meta:
+                freed = 0
+                
                 # Xóa file text
                 filepath = os.path.join(self.docs_dir, doc_meta['filename'])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                freed += self._remove_file(filepath)
                 
                 # Xóa tất cả attachments
                 for attachment in doc_meta.get('attachments', []):
                     attach_path = os.path.join(self.docs_uploads_dir, attachment['filename'])
-                    if os.path.exists(attach_path):
-                        os.remove(attach_path)
+                    freed += self._remove_file(attach_path)
                 
                 # Xóa metadata
                 metadata['docs'].remove(doc_meta)
+                self._add_storage_bytes(metadata, -freed)
+                self._doc_content_cache.pop(doc_meta['id'], None)
                 self._save_metadata(metadata)
                 return True
-        return False
+            return False
     
     def add_doc_attachment(self, doc_id, uploaded_file):
         """Thêm file đính kèm vào document"""
-        import uuid
-        from werkzeug.utils import secure_filename
+        self._load_metadata()
+        if int(doc_id) not in self._docs_by_id:
+            return False
         
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
-                # Lấy phần mở rộng file
-                original_filename = secure_filename(uploaded_file.filename)
-                if not original_filename:
-                    return False
-                    
-                file_ext = os.path.splitext(original_filename)[1]
-                
-                # Tạo tên file duy nhất
-                unique_filename = f"{doc_id}_{uuid.uuid4().hex[:8]}{file_ext}"
-                filepath = os.path.join(self.docs_uploads_dir, unique_filename)
-                
-                # Lưu file
-                uploaded_file.save(filepath)
-                
-                # Thêm vào metadata
-                if 'attachments' not in doc_meta:
-                    doc_meta['attachments'] = []
-                
-                doc_meta['attachments'].append({
-                    'filename': unique_filename,
-                    'original_filename': original_filename,
-                    'uploaded_at': datetime.utcnow().isoformat()
-                })
-                doc_meta['updated_at'] = datetime.utcnow().isoformat()
-                
-                self._save_metadata(metadata)
-                return True
-        return False
+        # Lấy phần mở rộng file
+        original_filename = secure_filename(uploaded_file.filename)
+        if not original_filename:
+            return False
+        
+        file_ext = os.path.splitext(original_filename)[1]
+        
+        # Tạo tên file duy nhất
+        unique_filename = f"{doc_id}_{secrets.token_hex(4)}{file_ext}"
+        filepath = os.path.join(self.docs_uploads_dir, unique_filename)
+        
+        # Lưu file (ngoài lock để upload lớn không chặn các request khác)
+        written = self._save_upload(uploaded_file, filepath)
+        
+        with self._lock:
+            metadata = self._load_metadata()
+            doc_meta = self._docs_by_id.get(int(doc_id))
+            if not doc_meta:
+                # Document bị xóa trong lúc đang upload
+                self._remove_file(filepath)
+                return False
+            
+            self._add_storage_bytes(metadata, written)
+            
+            # Thêm vào metadata
+            if 'attachments' not in doc_meta:
+                doc_meta['attachments'] = []
+            
+            doc_meta['attachments'].append({
+                'filename': unique_filename,
+                'original_filename': original_filename,
+                'uploaded_at': datetime.utcnow().isoformat()
+            })
+            doc_meta['updated_at'] = datetime.utcnow().isoformat()
+            
+            self._save_metadata(metadata)
+        return True
     
     def delete_doc_attachment(self, doc_id, attachment_filename):
         """Xóa file đính kèm từ document"""
-        metadata = self._load_metadata()
-        for doc_meta in metadata['docs']:
-            if doc_meta['id'] == int(doc_id):
+        with self._lock:
+            metadata = self._load_metadata()
+            doc_meta = self._docs_by_id.get(int(doc_id))
+            if doc_meta:
                 attachments = doc_meta.get('attachments', [])
                 for attachment in attachments:
                     if attachment['filename'] == attachment_filename:
                         # Xóa file vật lý
                         filepath = os.path.join(self.docs_uploads_dir, attachment_filename)
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
+                        self._add_storage_bytes(metadata, -self._remove_file(filepath))
                         
                         # Xóa khỏi metadata
                         attachments.remove(attachment)
                         doc_meta['updated_at'] = datetime.utcnow().isoformat()
                         self._save_metadata(metadata)
                         return True
-        return False
+            return False
     
     def get_doc_categories(self):
         """Lấy danh sách categories của documents"""
         metadata = self._load_metadata()
         categories = set()
-        for doc_meta in metadata.get('docs', []):
+        for doc_meta in list(metadata.get('docs', [])):
             categories.add(doc_meta.get('category', 'general'))
         return sorted(list(categories))
 
 
+class _IsoDatetime:
+    """Descriptor cho created_at/updated_at: giữ nguyên chuỗi ISO từ metadata, chỉ parse sang datetime khi được truy cập"""
+    def __set_name__(self, owner, name):
+        self.attr = '_' + name
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.attr)
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+            setattr(obj, self.attr, value)
+        return value
+    
+    def __set__(self, obj, value):
+        setattr(obj, self.attr, value)
+
+
 class Note:
     """Note class"""
+    created_at = _IsoDatetime()
+    updated_at = _IsoDatetime()
+    
     def __init__(self, id, title, content, category='general', user_id=None, 
                  attachments=None, view_count=0, created_at=None, updated_at=None, updated_by=None):
         self.id = id
@@ -594,12 +943,15 @@ class Note:
         self.attachments = attachments or []
         self.view_count = view_count
         self.created_at = created_at or datetime.utcnow()
-        self.updated_at = updated_at or self.created_at
+        self.updated_at = updated_at or self._created_at
         self.updated_by = updated_by
 
 
 class Document:
     """Document class"""
+    created_at = _IsoDatetime()
+    updated_at = _IsoDatetime()
+    
     def __init__(self, id, title, content, category='general', user_id=None,
                  attachments=None, created_at=None, updated_at=None):
         self.id = id
@@ -609,5 +961,5 @@ class Document:
         self.user_id = user_id
         self.attachments = attachments or []
         self.created_at = created_at or datetime.utcnow()
-        self.updated_at = updated_at or self.created_at
+        self.updated_at = updated_at or self._created_at
 